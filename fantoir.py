@@ -12,10 +12,13 @@ lecture d'après la description officielle (cf. site) + ajustements
 """
 
 import zipfile
+import gzip
 import sqlite3
 import os
 import argparse
 import glob
+import queue
+import threading
 
 try:
     from tqdm import tqdm
@@ -25,6 +28,21 @@ except ImportError:
     def tqdm(it, *args, **kwargs):
         return it
 
+# décompression parallèle des archives gzip, facultative
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+
+# nombre de lignes lues entre deux insertions par lots
+BATCH_SIZE = 10000
+
+# taille des blocs lus dans l'archive
+READ_SIZE = 4 * 1024 * 1024
+
+# nombre de blocs décompressés d'avance
+PREFETCH_BLOCKS = 4
 
 #
 # description du fichier FANTOIR
@@ -129,79 +147,176 @@ enregistrement_final = [
 ]
 
 
-def decode(fields, line):
+# types d'enregistrement, dans l'ordre des indices retournés par classify()
+enregistrements = [enregistrement_final,
+                   enregistrement_initial,
+                   enregistrement_direction,
+                   enregistrement_commune,
+                   enregistrement_voie]
+
+
+def classify(line):
+    """
+    détermine le type d'enregistrement d'une ligne d'après des positions fixes
+    retourne l'indice de sa description dans enregistrements
+    """
+    if line.startswith(b'9999999999'):
+        return 0
+    if line[0:10] == b'\0' * 10:
+        return 1
+    # les enregistrements direction et commune ont la même longueur:
+    # seule la direction n'a pas de code commune
+    if line[3:11] == b' ' * 8:
+        return 2
+    if line[6:10] == b' ' * 4:
+        return 3
+    return 4
+
+
+def compile_layout(fields):
     """
-    analyse une ligne selon la description fields
-    retourne un dict si ok ou rien
+    précalcule la position de chaque champ de la description fields
+    retourne les noms et les bornes des champs à conserver, et les remplissages à vérifier
     """
-    row = {}
+    keep_names = []
+    keep_slices = []
+    filler_checks = []
     offset = 0
     for field in fields[1:]:
         width, name = field[:2]
-        value = line[offset:offset + width]
         if name == FILLER_ANY:
             pass
         elif name.startswith('_'):
             # space, 0, 9, etc.
-            if value != name[1].encode() * width:
-                return
+            filler_checks.append((offset, offset + width, width, name[1].encode()))
         else:
-            if value == '':
-                print(line)
-                assert False
-                return
-            row[name] = str.rstrip(value.decode())
+            keep_names.append(name)
+            keep_slices.append((offset, offset + width))
         offset += width
-    row['trailing'] = line[offset:]
-    return row
+    return keep_names, keep_slices, filler_checks
 
 
-def create(db, fields):
+def decode(layout, line):
     """
-    crée les tables de la base de données
+    analyse une ligne selon la description précalculée layout
+    retourne un tuple des valeurs dans l'ordre des colonnes si ok ou rien
     """
-    sql = f"create table {fields[0]} (line number"
-    for field in fields[1:]:
-        width, name = field[:2]
-        if not name.startswith("_"):
-            sql += f", {name} text({width})"
+    _, keep_slices, filler_checks = layout
+    for start, end, width, fill in filler_checks:
+        # comptage sans allocation plutôt que comparaison de tranches
+        if line.count(fill, start, end) != width:
+            return
+    return tuple(line[start:end].rstrip(b' ').decode('ascii') for start, end in keep_slices)
+
+
+def create(db, table, layout):
+    """
+    crée les tables de la base de données d'après la description précalculée layout
+    retourne la requête d'insertion dans la table
+    """
+    keep_names, keep_slices, _ = layout
+    sql = f"create table {table} (line number"
+    for name, (start, end) in zip(keep_names, keep_slices):
+        sql += f", {name} text({end - start})"
     sql += ")"
     db.execute(sql)
+    return f"insert into {table} values ({','.join('?' * (1 + len(keep_names)))})"
 
 
-def insert(db, fields, row, n):
+def insert(fields, row, n, pending):
     """
-    insère un enregistrement dans la base de données
+    ajoute un enregistrement aux lignes en attente d'insertion
     """
-    names = ['line']
-    values = [n]
-    for field in fields[1:]:
-        width, name = field[:2]
-        if not name.startswith("_"):
-            names.append(name)
-            values.append(row[name])
+    pending[fields[0]].append((n, *row))
 
-    sql = f"insert into {fields[0]} ({','.join(names)}) values ({','.join('?' * len(values))})"
-    db.execute(sql, values)
+
+def flush(db, statements, pending):
+    """
+    insère par lots les enregistrements en attente dans la base de données
+    """
+    for table, rows in pending.items():
+        if rows:
+            db.executemany(statements[table], rows)
+            rows.clear()
+
+
+def split_blocks(raw, name):
+    """
+    itérateur sur les blocs de lignes lus dans le flux raw
+    les lignes sont retournées sans la fin de ligne \\r\\n
+    """
+    # lecture par gros blocs: évite le découpage ligne à ligne
+    buf = b''
+    while True:
+        chunk = raw.read(READ_SIZE)
+        if not chunk:
+            break
+        data = buf + chunk
+        lines = data.split(b'\r\n')
+        buf = lines.pop()
+        # contrôle par bloc plutôt que par ligne: chaque \\n doit terminer un \\r\\n
+        if data.count(b'\n') != len(lines) or len(buf) > READ_SIZE:
+            raise ValueError(f"{name}: lignes non terminées par \\r\\n")
+        yield lines
+    if buf:
+        raise ValueError(f"{name}: dernière ligne non terminée par \\r\\n")
+
+
+def read_blocks(archive):
+    """
+    itérateur sur les blocs de lignes du fichier contenu dans l'archive ZIP ou gzip
+    """
+    if str(archive).endswith('.gz'):
+        # décompression parallèle si rapidgzip est installé
+        if rapidgzip:
+            raw = rapidgzip.open(archive, parallelization=os.cpu_count())
+        else:
+            raw = gzip.open(archive)
+        with raw:
+            yield from split_blocks(raw, archive)
+        return
+
+    with zipfile.ZipFile(archive) as zip:
+        for i in zip.infolist():
+            # blocs plus grands que le tampon de zipfile
+            with zip.open(i) as raw:
+                yield from split_blocks(raw, i.filename)
 
 
 def fantoir(archive):
     """
-    itérateur sur chaque ligne du fichier contenu dans l'archive ZIP
+    itérateur sur chaque ligne du fichier contenu dans l'archive ZIP ou gzip
+    la décompression (qui libère le GIL) se fait dans un thread séparé,
+    en parallèle de l'analyse et de l'insertion des lignes
     """
-    zip = zipfile.ZipFile(archive)
-    for i in zip.infolist():
-        for line in zip.open(i.filename):
-            yield line
+    blocks = queue.Queue(maxsize=PREFETCH_BLOCKS)
+
+    def reader():
+        try:
+            for lines in read_blocks(archive):
+                blocks.put(lines)
+        except Exception as e:
+            blocks.put(e)
+        blocks.put(None)
+
+    threading.Thread(target=reader, daemon=True).start()
+
+    while True:
+        lines = blocks.get()
+        if lines is None:
+            break
+        if isinstance(lines, Exception):
+            raise lines
+        yield from lines
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('archive', nargs='?', metavar='FANTOIR', help="Fichier national FANTOIR (archive)")
+    parser.add_argument('archive', nargs='?', metavar='FANTOIR', help="Fichier national FANTOIR (archive ZIP ou gzip)")
     args = parser.parse_args()
 
     if args.archive is None:
-        z = glob.glob('FANTOIR*.zip')
+        z = glob.glob('FANTOIR*.zip') + glob.glob('FANTOIR*.gz')
         if len(z) != 1:
             parser.print_help()
             exit(2)
@@ -211,51 +326,45 @@ def main():
         os.unlink("fantoir.sqlite")
     db = sqlite3.connect("fantoir.sqlite")
 
-    enregistrements = [enregistrement_final,
-                       enregistrement_initial,
-                       enregistrement_direction,
-                       enregistrement_commune,
-                       enregistrement_voie]
-
-    for e in enregistrements:
-        create(db, e)
+    # chargement en masse d'une base neuve: journal en mémoire (le rollback reste
+    # défini en cas d'erreur) et pas de synchronisation disque
+    # page_size doit être fixé avant la création des tables
+    db.executescript("""
+        PRAGMA page_size=65536;
+        PRAGMA journal_mode=MEMORY;
+        PRAGMA synchronous=OFF;
+        PRAGMA locking_mode=EXCLUSIVE;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-262144;
+    """)
+
+    layouts = [compile_layout(e) for e in enregistrements]
+
+    statements = {}
+    pending = {}
+    for e, layout in zip(enregistrements, layouts):
+        statements[e[0]] = create(db, e[0], layout)
+        pending[e[0]] = []
 
-    i = 1           # on commence par l'enregistrement initial
     n = 0           # compteur de ligne
 
-    for line in tqdm(fantoir(args.archive), unit=" lignes", desc=args.archive):
-        n += 1
+    # une seule transaction pour tout le fichier
+    with db:
+        for line in tqdm(fantoir(args.archive), unit=" lignes", desc=args.archive):
+            n += 1
 
-        assert line[-2:] == b'\r\n'
-        line = line[:-2]
-
-        while True:
-            row = decode(enregistrements[i], line)
-            if row:
-                # les enregistrements direction et commune ont la même longueur
-                if enregistrements[i][0] == 'commune':
-                    if row['code_comm'] == '':
-                        i -= 1
-                        continue
-
-                # le décodeur courant fonctionne: on ajoute l'enregistrement à la base de données
-                insert(db, enregistrements[i], row, n)
-
-                # on passe au décodeur suivant
-                if i < len(enregistrements) - 1:
-                    i += 1
-                break
+            i = classify(line)
+            row = decode(layouts[i], line)
+            if row is None:
+                print("problème ligne", n)
+                print(line)
             else:
-                if i <= 0:
-                    print("problème ligne", i)
-                    print(line)
-                assert i > 0
-                i -= 1
+                insert(enregistrements[i], row, n, pending)
 
-        if n % 10000 == 0:
-            db.commit()
+            if n % BATCH_SIZE == 0:
+                flush(db, statements, pending)
 
-    db.commit()
+        flush(db, statements, pending)
 
     print("{} lignes lues".format(n))
     for fields in enregistrements:
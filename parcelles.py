@@ -11,18 +11,97 @@
 #  ./parcelles.py -o elysee -p 75108BO25 -c 75108
 #  ./parcelles.py -f demo.yaml
 
-import json
 import argparse
 import requests
 import requests_cache
 import datetime
 import re
 import logging
-import gzip
 import simplekml
 from collections import defaultdict
 import yaml
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import cycle
+
+# décodeurs accélérés, s'ils sont installés
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+try:
+    from isal.igzip import decompress as gzip_decompress
+except ImportError:
+    from gzip import decompress as gzip_decompress
+
+
+# délai maximal d'attente du serveur, en secondes
+TIMEOUT = 30
+
+# nombre de téléchargements simultanés
+MAX_WORKERS = 8
+
+# identifiants: commune, parcelle (commune, préfixe, section, numéro), lieu-dit (commune, nom)
+COMMUNE_RE = re.compile(r"\d[\dAB]\d{3}", re.I)
+PARCELLE_RE = re.compile(r"(\d[\dAB]\d{3})?(\d{0,3})([0A-Z]?[A-Z])(\d{1,4})")
+LIEU_DIT_RE = re.compile(r"(\d[\dAB]\d{3})?:?([A-Z.\-'_ ]+|\*)?")
+
+# couleurs au format KML 'aabbggrr' ou Web '#rrggbb'
+COULEUR_KML_RE = re.compile(r'[0-9a-f]{6,8}', re.I)
+COULEUR_WEB_RE = re.compile(r'#[0-9a-f]{6}', re.I)
+
+# palettes de couleurs prédéfinies
+COLORS = {
+    # nuances de rouge
+    "red": ['99{:02x}{:02x}ff'.format(max(0, 64 * i - 1), max(0, 64 * i - 1)) for i in range(3)],
+    # nuances de vert
+    "green": ['99{:02x}ff{:02x}'.format(max(0, 64 * i - 1), max(0, 64 * i - 1)) for i in range(3)],
+    # nuances de bleu
+    "blue": ['99ff{:02x}{:02x}'.format(max(0, 64 * i - 1), max(0, 64 * i - 1)) for i in range(3)],
+    # alternance de couleurs
+    "all": ['990000ff',  # Transparent red
+            '9900ff00',
+            '99ff0000',
+            '997f7fff',
+            '997fff7f',
+            '997f7fff'],
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    retourne la session HTTP partagée (connexions persistantes)
+    créée au premier appel, donc après l'installation éventuelle du cache
+    le premier appel peut venir de plusieurs threads de téléchargement à la fois
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+    return _session
+
+
+@lru_cache(maxsize=256)
+def download_geojson(url):
+    """
+    télécharge et décode un document GeoJSON compressé
+    lève une exception en cas d'échec: seuls les succès sont mémorisés
+    """
+    req = get_session().get(url, timeout=TIMEOUT)
+    if req.status_code != 200:
+        raise requests.HTTPError("HTTP {}".format(req.status_code), response=req)
+    return json_loads(gzip_decompress(req.content))
 
 
 def get_geojson(commune, source="parcelles"):
@@ -31,6 +110,7 @@ def get_geojson(commune, source="parcelles"):
     les sources disponibles sont:
         ['batiments', 'communes', 'feuilles', 'lieux_dits', 'parcelles',
          'prefixes_sections', 'sections', 'subdivisions_fiscales']
+    le résultat est mémorisé et partagé entre les appels: ne pas le modifier
     """
 
     # récupère le numéro de département
@@ -43,15 +123,27 @@ def get_geojson(commune, source="parcelles"):
     # l'url du document GeoJSON à downloader
     url = f'https://cadastre.data.gouv.fr/data/etalab-cadastre/latest/geojson/communes/{dept}/{commune}/cadastre-{commune}-{source}.json.gz'
 
-    req = requests.get(url)
-    if req.status_code != 200:
+    try:
+        return download_geojson(url)
+    except requests.HTTPError as e:
         logging.info("url: %s", url)
-        logging.error("mauvaise commune ou problème réseau (HTTP {})".format(req.status_code))
-    else:
-        try:
-            return json.loads(gzip.decompress(req.content))
-        except Exception as e:
-            logging.error("Impossible d'analyser le contenu GeoJSON: {}".format(e))
+        logging.error("mauvaise commune ou problème réseau ({})".format(e))
+    except requests.RequestException:
+        raise
+    except Exception as e:
+        logging.error("Impossible d'analyser le contenu GeoJSON: {}".format(e))
+
+
+def get_geojson_communes(communes, source="parcelles"):
+    """
+    charge en parallèle une donnée du PCI pour plusieurs communes
+    retourne une liste de (commune, GeoJSON) dans l'ordre des communes
+    """
+    communes = list(communes)
+    if len(communes) <= 1:
+        return [(commune, get_geojson(commune, source)) for commune in communes]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(zip(communes, executor.map(lambda commune: get_geojson(commune, source), communes)))
 
 
 def check_uniqueness(kml, id):
@@ -134,7 +226,7 @@ class Parcelles:
             return
         for p1 in args:
             for p2 in p1.upper().split(','):
-                m = re.match(r"(\d[\dAB]\d{3})?(\d{0,3})([0A-Z]?[A-Z])(\d{1,4})", p2)
+                m = PARCELLE_RE.match(p2)
                 if not m:
                     parser.error("Mauvais id de parcelle: %s", p2)
                     continue
@@ -159,46 +251,31 @@ class Parcelles:
         ajoute le dessin des parcelles à un kml
         color_scheme : méthode pour affecter des couleurs
         """
-        ncolor = 0
-
         if color_scheme is None:
             color_scheme = "all"
 
-        if re.match(r'[0-9a-f]{6,8}', color_scheme, re.I):
+        if COULEUR_KML_RE.match(color_scheme):
             # couleur spécifiée au format KML 'aabbggrr'
             colors = [color_scheme]
-        elif re.match(r'#[0-9a-f]{6}', color_scheme, re.I):
+        elif COULEUR_WEB_RE.match(color_scheme):
             # couleur spécifiée au format Web '#rrggbb'
             colors = ['99' + color_scheme[5:7] + color_scheme[3:5] + color_scheme[1:3]]
-        elif color_scheme == "red":
-            # nuances de rouge
-            colors = ['99{:02x}{:02x}ff'.format(max(0, 64 * i - 1), max(0, 64 * i - 1)) for i in range(3)]
-        elif color_scheme == "green":
-            # nuances de vert
-            colors = ['99{:02x}ff{:02x}'.format(max(0, 64 * i - 1), max(0, 64 * i - 1)) for i in range(3)]
-        elif color_scheme == "blue":
-            # nuances de bleu
-            colors = ['99ff{:02x}{:02x}'.format(max(0, 64 * i - 1), max(0, 64 * i - 1)) for i in range(3)]
         else:
-            # alternance de couleurs
-            colors = ['990000ff',  # Transparent red
-                      '9900ff00',
-                      '99ff0000',
-                      '997f7fff',
-                      '997fff7f',
-                      '997f7fff']
+            colors = COLORS.get(color_scheme, COLORS["all"])
+        colors = cycle(colors)
 
-        for commune, liste_id in self.parcelles.items():
-            data = get_geojson(commune)
+        for commune, data in get_geojson_communes(self.parcelles):
+            liste_id = self.parcelles[commune]
 
-            for feature in data['features']:
-                properties = feature['properties']
-                for id in liste_id:
-                    if properties['id'] == id and check_uniqueness(kml, id):
-                        logging.debug(properties)
-                        print("parcelle {id} :  taille {contenance:>10}  créée {created}, mise à jour {updated}".format(**properties))
-                        add_feature(kml, feature, colors[ncolor % len(colors)])
-                        ncolor += 1
+            by_id = {feature['properties']['id']: feature for feature in data['features']}
+
+            for id in liste_id:
+                feature = by_id.get(id)
+                if feature and check_uniqueness(kml, id):
+                    properties = feature['properties']
+                    logging.debug(properties)
+                    print("parcelle {id} :  taille {contenance:>10}  créée {created}, mise à jour {updated}".format(**properties))
+                    add_feature(kml, feature, next(colors))
 
 
 class Communes:
@@ -215,7 +292,7 @@ class Communes:
             return
         for commune in communes:
             commune = str(commune)
-            if not re.match(r"\d[\dAB]\d{3}", commune, re.I):
+            if not COMMUNE_RE.fullmatch(commune):
                 parser.error("Mauvais numéro de commune: %s" % commune)
             else:
                 self.communes.add(commune.upper())
@@ -224,8 +301,7 @@ class Communes:
         """
         ajoute le contour des communes sélectionnées au kml, trait vert
         """
-        for commune in self.communes:
-            data = get_geojson(commune, "communes")
+        for commune, data in get_geojson_communes(self.communes, "communes"):
 
             for feature in data['features']:
                 if check_uniqueness(kml, feature['id']):
@@ -250,7 +326,7 @@ class LieuxDits:
             args = ['*']
         for p1 in args:
             for p2 in p1.upper().split(','):
-                m = re.match(r"(\d[\dAB]\d{3})?:?([A-Z.\-'_ ]+|\*)?", p2)
+                m = LIEU_DIT_RE.match(p2)
                 if not m:
                     parser.error("Mauvais id de parcelle: %s" % p2)
                     continue
@@ -268,23 +344,29 @@ class LieuxDits:
     def to_kml(self, kml):
         """
         ajoute le contour des lieux-dits sélectionnés au kml, trait rouge
+        les lieux-dits sont ajoutés dans l'ordre demandé (ordre du fichier pour '*')
         """
-        for commune, liste_id in self.parcelles.items():
-            data = get_geojson(commune, "lieux_dits")
+        for commune, data in get_geojson_communes(self.parcelles, "lieux_dits"):
+            liste_id = self.parcelles[commune]
             if not data:
                 # pas de lieux-dits
                 return
 
-            for feature in data['features']:
+            if '*' in liste_id:
+                features = data['features']
+            else:
+                by_nom = {}
+                for feature in data['features']:
+                    by_nom.setdefault((feature['properties']['nom'] or '').upper(), []).append(feature)
+                features = [feature for id in liste_id for feature in by_nom.get(id, [])]
+
+            for feature in features:
                 properties = feature['properties']
-                for id in liste_id:
-                    if id == '*' or properties['nom'].upper() == id:
-                        name = properties['nom'] or '??'
-                        if check_uniqueness(kml, name):
-                            properties = feature['properties']
-                            logging.debug(properties)
-                            print("lieu-dit {nom} : commune {commune}  créée {created}, mise à jour {updated}".format(**properties))
-                            add_feature_contour(kml, feature, 'ff1522fc', name)
+                name = properties['nom'] or '??'
+                if check_uniqueness(kml, name):
+                    logging.debug(properties)
+                    print("lieu-dit {nom} : commune {commune}  créée {created}, mise à jour {updated}".format(**properties))
+                    add_feature_contour(kml, feature, 'ff1522fc', name)
 
 
 def main():
@@ -332,7 +414,8 @@ def main():
 
     # si on a donné un ou plusieurs fichiers de configuration
     for file in args.file or []:
-        conf = yaml.load(open(file))
+        with open(file, 'rb') as f:
+            conf = yaml.load(f, Loader=YamlLoader)
         if 'titre' in conf:
             print('--', conf['titre'], '--')
         if 'donnees' in conf: